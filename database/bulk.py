@@ -0,0 +1,68 @@
+from typing import Optional
+
+from database.models import ContentPlan
+from database.sessions import session_scope, transaction_scope
+from logging_errors.logging_setup import logger
+
+from sqlalchemy import insert
+
+# Начиная с этого количества строк вставка выполняется через COPY
+COPY_THRESHOLD = 100
+
+CONTENT_PLAN_COLUMNS = ("telegram_id", "message", "media_path", "publish_date")
+
+
+async def bulk_insert_content_plan(session_maker, rows: list[dict]) -> Optional[True]:
+    """
+    Массово добавляет сообщения в таблицу ContentPlan.
+
+    Параметры:
+    - rows (list[dict]): Список сообщений вида {"telegram_id": str, "message": str,
+     "publish_date": date, "media_path": str | None}.
+
+    Примечания:
+    - Если строк меньше COPY_THRESHOLD, выполняется INSERT ... VALUES со всеми строками
+     (insertmanyvalues, по insertmanyvalues_page_size строк в запросе).
+    - Иначе строки передаются через COPY (copy_records_to_table в asyncpg) внутри
+     той же транзакции, что и остальные запросы сессии.
+    - Проверки create_content_plan_message (существование пользователя, дубликаты на дату)
+     не выполняются.
+
+    Возвращает:
+    - True - если сообщения добавлены.
+    При ошибке - None.
+    """
+    logger.info("*БД* Вызвана функция bulk_insert_content_plan")
+    if not rows:
+        return True
+    try:
+        async with session_scope(session_maker) as session:
+            async with transaction_scope(session):
+                if len(rows) < COPY_THRESHOLD:
+                    values = [
+                        {column: row.get(column) for column in CONTENT_PLAN_COLUMNS}
+                        for row in rows
+                    ]
+                    await session.execute(insert(ContentPlan), values)
+                else:
+                    connection = await session.connection()
+                    raw_connection = await connection.get_raw_connection()
+                    driver_connection = raw_connection.driver_connection
+                    # Адаптер asyncpg в SQLAlchemy начинает транзакцию только перед
+                    # первым своим запросом: без него COPY выполнился бы вне
+                    # транзакции и зафиксировался сразу
+                    if not driver_connection.is_in_transaction():
+                        await connection.exec_driver_sql("SELECT 1")
+                    await driver_connection.copy_records_to_table(
+                        ContentPlan.__tablename__,
+                        records=[
+                            tuple(row.get(column) for column in CONTENT_PLAN_COLUMNS)
+                            for row in rows
+                        ],
+                        columns=CONTENT_PLAN_COLUMNS,
+                    )
+                return True
+    except Exception as error:
+        logger.exception(
+            f"*БД* Произошла ошибка в функции bulk_insert_content_plan: {error}"
+        )
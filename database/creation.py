@@ -1,26 +1,228 @@
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex, CreateTable, DropTable
+
 from database.models import Base, ContentPlan
 from database.engine import async_engine
 import asyncio
 
 
-async def create_tables(engine):
+def _create_ddl(dialect) -> dict[str, str]:
+    """
+    Собирает DDL создания каждой таблицы вместе с ее индексами.
+    :param dialect: Диалект БД, под который компилируются выражения.
+    :return: Словарь {имя таблицы: выражения CREATE TABLE/CREATE INDEX, разделенные
+     ';'} в порядке зависимостей внешних ключей.
+    """
+    ddl = {}
+    for table in Base.metadata.sorted_tables:
+        statements = [
+            str(CreateTable(table, if_not_exists=True).compile(dialect=dialect))
+        ]
+        for index in table.indexes:
+            statements.append(
+                str(CreateIndex(index, if_not_exists=True).compile(dialect=dialect))
+            )
+        ddl[table.name] = ";\n".join(statements)
+    return ddl
+
+
+def _drop_ddl(dialect) -> str:
+    """
+    Собирает DDL удаления всех таблиц в один скрипт (в обратном порядке зависимостей).
+    :param dialect: Диалект БД, под который компилируются выражения.
+    :return: Строка с выражениями DROP TABLE, разделенными ';'.
+    """
+    statements = [
+        str(DropTable(table, if_exists=True).compile(dialect=dialect))
+        for table in reversed(Base.metadata.sorted_tables)
+    ]
+    return ";\n".join(statements)
+
+
+async def _execute_script(conn, script: str):
+    """
+    Выполняет скрипт из нескольких выражений одним запросом к БД.
+    Запрос без параметров asyncpg отправляет по simple query протоколу: весь скрипт
+     уходит за один round-trip и выполняется в одной транзакции.
+    :param conn: Асинхронное соединение с БД.
+    :param script: Скрипт из нескольких SQL выражений.
+    """
+    raw_connection = await conn.get_raw_connection()
+    await raw_connection.driver_connection.execute(script)
+
+
+def _table_levels() -> list[list]:
+    """
+    Группирует таблицы по уровням зависимостей внешних ключей: таблицы одного уровня
+     не ссылаются друг на друга и могут создаваться параллельно.
+    :return: Список уровней, каждый уровень - список таблиц.
+    """
+    depth = {}
+    for table in Base.metadata.sorted_tables:
+        parents = [
+            fk.column.table for fk in table.foreign_keys if fk.column.table is not table
+        ]
+        depth[table] = max((depth[parent] + 1 for parent in parents), default=0)
+
+    levels = [[] for _ in range(max(depth.values(), default=-1) + 1)]
+    for table, level in depth.items():
+        levels[level].append(table)
+    return levels
+
+
+async def _create_table(engine, table):
+    """
+    Создает одну таблицу (с индексами) в отдельном соединении из пула.
+    :param engine: Асинхронный движок для выполнения операций с БД.
+    :param table: Таблица для создания.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(table.create, checkfirst=True)
+
+
+async def _drop_table(engine, table):
+    """
+    Удаляет одну таблицу в отдельном соединении из пула.
+    :param engine: Асинхронный движок для выполнения операций с БД.
+    :param table: Таблица для удаления.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(table.drop, checkfirst=True)
+
+
+# DDL компилируется один раз при импорте модуля
+_CREATE_DDL = _create_ddl(async_engine.dialect)
+_DROP_DDL = _drop_ddl(async_engine.dialect)
+
+# Обновления схемы, созданной предыдущими версиями бота. Каждый шаг проверяет
+# схему сам и ничего не делает, если он уже применен или таблицы еще нет: ALTER
+# TABLE берет эксклюзивную блокировку даже с IF NOT EXISTS
+_ADD_COLUMN_CONTENT_PLAN_SENT = """
+    DO $$
+    BEGIN
+        IF to_regclass('content_plan') IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema()
+                AND table_name = 'content_plan' AND column_name = 'sent'
+        ) THEN
+            ALTER TABLE content_plan ADD COLUMN sent BOOLEAN NOT NULL DEFAULT false;
+        END IF;
+    END $$
+"""
+_ADD_COLUMN_USERS_BLOCKED_AT = """
+    DO $$
+    BEGIN
+        IF to_regclass('users') IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema()
+                AND table_name = 'users' AND column_name = 'blocked_at'
+        ) THEN
+            ALTER TABLE users ADD COLUMN blocked_at TIMESTAMP;
+        END IF;
+    END $$
+"""
+_MOVE_REFERRAL_INFO_TO_USERS = """
+    DO $$
+    BEGIN
+        IF to_regclass('referral_info') IS NOT NULL THEN
+            ALTER TABLE users ADD COLUMN IF NOT EXISTS real_name VARCHAR(60);
+            ALTER TABLE users ADD COLUMN IF NOT EXISTS user_url_for_message TEXT;
+            UPDATE users
+            SET real_name = referral_info.real_name,
+                user_url_for_message = referral_info.user_url_for_message
+            FROM referral_info
+            WHERE users.info_ref_id = referral_info.info_id;
+            ALTER TABLE users DROP COLUMN IF EXISTS info_ref_id;
+            DROP TABLE referral_info;
+        END IF;
+    END $$
+"""
+_UPGRADE_DDL = ";\n".join(
+    [
+        _ADD_COLUMN_CONTENT_PLAN_SENT,
+        _ADD_COLUMN_USERS_BLOCKED_AT,
+        _MOVE_REFERRAL_INFO_TO_USERS,
+    ]
+)
+
+
+async def upgrade_tables_fast(conn):
+    """
+    Приводит таблицы, созданные предыдущими версиями бота, к текущей схеме
+     (столбцы content_plan.sent, users.blocked_at, перенос referral_info в users)
+     одним запросом. Повторный вызов ничего не меняет.
+    Вызывается до create_tables_fast.
+    :param conn: Асинхронное соединение с БД (PostgreSQL).
+    """
+    await _execute_script(conn, _UPGRADE_DDL)
+
+
+async def create_tables_fast(conn):
+    """
+    Создает отсутствующие таблицы и их индексы заранее скомпилированным скриптом
+     за один запрос.
+    Индексы создаются только для таблиц, созданных в этом вызове (как checkfirst
+     в create_all): CREATE INDEX на существующей таблице блокирует запись в нее,
+     а индекс может ссылаться на столбец, которого в старой схеме еще нет. Индексы
+     существующих таблиц создает create_indexes (CONCURRENTLY).
+    :param conn: Асинхронное соединение с БД (PostgreSQL).
+    """
+    result = await conn.execute(
+        text(
+            "SELECT name FROM unnest(CAST(:names AS text[])) AS name "
+            "WHERE to_regclass(name) IS NULL"
+        ),
+        {"names": list(_CREATE_DDL)},
+    )
+    missing = set(result.scalars())
+    if not missing:
+        return
+    script = ";\n".join(
+        statements for name, statements in _CREATE_DDL.items() if name in missing
+    )
+    await _execute_script(conn, script)
+
+
+async def drop_tables_fast(conn):
+    """
+    Удаляет таблицы из БД заранее скомпилированным скриптом за один запрос.
+    :param conn: Асинхронное соединение с БД (PostgreSQL).
+    """
+    await _execute_script(conn, _DROP_DDL)
+
+
+async def create_tables(engine, batch: bool = True):
     """
     Создает таблицы в БД
     :param engine: Асинхронный движок для выполнения операций с БД.
+    :param batch: Если True (и БД - PostgreSQL), весь DDL отправляется одним скриптом,
+     иначе независимые таблицы создаются параллельно по уровням внешних ключей.
     :return: None
     """
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    if batch and engine.dialect.name == "postgresql":
+        async with engine.begin() as conn:
+            await create_tables_fast(conn)
+        return
 
+    for level in _table_levels():
+        await asyncio.gather(*[_create_table(engine, table) for table in level])
 
-async def drop_tables(engine):
+
+async def drop_tables(engine, batch: bool = True):
     """
     Удаляет таблицы из БД.
     :param engine: Асинхронный движок для выполнения операций с БД.
+    :param batch: Если True (и БД - PostgreSQL), весь DDL отправляется одним скриптом,
+     иначе независимые таблицы удаляются параллельно по уровням внешних ключей.
     :return: None
     """
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.drop_all)
+    if batch and engine.dialect.name == "postgresql":
+        async with engine.begin() as conn:
+            await drop_tables_fast(conn)
+        return
+
+    for level in reversed(_table_levels()):
+        await asyncio.gather(*[_drop_table(engine, table) for table in level])
 
 
 async def create_table_content_plan(engine):
@@ -41,6 +243,55 @@ async def drop_table_content_plan(engine):
         await conn.run_sync(ContentPlan.__table__.drop)
 
 
+async def add_column_content_plan_sent(engine):
+    """
+    Добавляет столбец sent в таблицу content_plan при уже существующей таблице.
+    :param engine: Асинхронный движок для выполнения операций с БД.
+    """
+    async with engine.begin() as conn:
+        await _execute_script(conn, _ADD_COLUMN_CONTENT_PLAN_SENT)
+
+
+async def add_column_users_blocked_at(engine):
+    """
+    Добавляет столбец blocked_at в таблицу users при уже существующей таблице.
+    :param engine: Асинхронный движок для выполнения операций с БД.
+    """
+    async with engine.begin() as conn:
+        await _execute_script(conn, _ADD_COLUMN_USERS_BLOCKED_AT)
+
+
+async def move_referral_info_to_users(engine):
+    """
+    Переносит данные таблицы referral_info в столбцы таблицы users и удаляет
+    таблицу referral_info при уже существующих таблицах.
+    :param engine: Асинхронный движок для выполнения операций с БД.
+    """
+    async with engine.begin() as conn:
+        await _execute_script(conn, _MOVE_REFERRAL_INFO_TO_USERS)
+
+
+async def create_indexes(engine):
+    """
+    Создает индексы моделей в БД при уже существующих таблицах.
+    Индексы создаются через CREATE INDEX CONCURRENTLY, без блокировки записи в таблицы,
+     поэтому выполняются вне транзакции (AUTOCOMMIT).
+    :param engine: Асинхронный движок для выполнения операций с БД.
+    """
+    autocommit_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
+    async with autocommit_engine.connect() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                # postgresql_concurrently включается только на время этого запроса:
+                # в create_tables индексы создаются внутри транзакции, где
+                # CONCURRENTLY запрещен
+                index.dialect_kwargs["postgresql_concurrently"] = True
+                try:
+                    await conn.execute(CreateIndex(index, if_not_exists=True))
+                finally:
+                    index.dialect_kwargs["postgresql_concurrently"] = False
+
+
 # Создает все таблицы
 # asyncio.run(create_tables(async_engine))
 
@@ -52,3 +303,15 @@ async def drop_table_content_plan(engine):
 
 # Удаляет таблицу ContentPlan
 # asyncio.run(drop_table_content_plan(async_engine))
+
+# Добавляет столбец sent в таблицу ContentPlan
+# asyncio.run(add_column_content_plan_sent(async_engine))
+
+# Добавляет столбец blocked_at в таблицу Users
+# asyncio.run(add_column_users_blocked_at(async_engine))
+
+# Переносит ReferralInfo в Users
+# asyncio.run(move_referral_info_to_users(async_engine))
+
+# Создает индексы при уже существующих таблицах
+# asyncio.run(create_indexes(async_engine))
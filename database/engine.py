@@ -2,6 +2,11 @@ from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sess
 from sqlalchemy.engine import URL
 from config_data.config import USERNAME_DB, HOST_DB, DATABASE_DB, PASSWORD_DB
 
+# Размер кэша подготовленных выражений asyncpg (statement_cache_size) и SQLAlchemy
+# (prepared_statement_cache_size) на одно соединение.
+# За pgbouncer в режиме transaction оба значения нужно выставить в 0.
+STATEMENT_CACHE_SIZE = 512
+
 
 def create_async_my_engine(url):
     """
@@ -11,9 +16,29 @@ def create_async_my_engine(url):
     - echo=True: Устанавливает вывод всех операций в базе данных для отладки
     - future=True: Использует асинхронные функции и классы для взаимодействия с БД
     - pool_pre_ping=True: Проверяет подключение к БД перед использованием из пула соединений
+    - pool_size=20, max_overflow=30: Постоянные и дополнительные соединения пула, чтобы
+      одновременные обработчики обновлений Telegram не ждали свободного соединения
+    - pool_recycle=3600: Переоткрывает соединения старше часа
+    - insertmanyvalues_page_size=1000: Количество строк в одном INSERT ... VALUES
+      при массовой вставке (executemany)
+    - connect_args: Размеры кэшей подготовленных выражений, чтобы частые запросы
+      не подготавливались на сервере повторно
     """
 
-    return create_async_engine(url, echo=False, future=True, pool_pre_ping=True)
+    return create_async_engine(
+        url,
+        echo=False,
+        future=True,
+        pool_pre_ping=True,
+        pool_size=20,
+        max_overflow=30,
+        pool_recycle=3600,
+        insertmanyvalues_page_size=1000,
+        connect_args={
+            "statement_cache_size": STATEMENT_CACHE_SIZE,
+            "prepared_statement_cache_size": STATEMENT_CACHE_SIZE,
+        },
+    )
 
 
 def create_async_session(engine):
@@ -21,10 +46,16 @@ def create_async_session(engine):
     Создает асинхронную сессию для взаимодействия с базой данных
     :param engine: Асинхронный движок
     :return: Асинхронная сессия для выполнения операций с базой данных
-    - expire_on_commit=True: Гарантирует получение актуальных данных при параллельных изменениях вБД
+    - expire_on_commit=False: Не сбрасывает загруженные объекты после commit, чтобы
+      обращение к их атрибутам не вызывало повторный SELECT (в async - ошибку).
+      Сессия может жить дольше одного запроса: DbSessionMiddleware держит ее
+      на все обновление, рассылка - на весь запуск. Объекты, загруженные до
+      commit, в такой сессии не перечитываются и могут содержать устаревшие
+      данные: после commit нужные значения запрашиваются заново, а не берутся
+      из ранее загруженных объектов.
     """
 
-    return async_sessionmaker(engine, expire_on_commit=True, class_=AsyncSession)
+    return async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
 
 postgres_url = URL.create(
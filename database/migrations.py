@@ -0,0 +1,82 @@
+import asyncio
+import os
+from typing import Optional
+
+from sqlalchemy import text
+
+from database.creation import create_tables_fast, upgrade_tables_fast
+from logging_errors.logging_setup import logger
+
+# Режим применения схемы при старте бота:
+# - async: в фоне, бот сразу начинает обрабатывать обновления;
+# - sync: старт бота ждет окончания создания таблиц;
+# - skip: схема не применяется.
+MIGRATION_MODES = ("async", "sync", "skip")
+MIGRATION_MODE = os.getenv("MIGRATION_MODE", "async")
+
+# Ключ advisory lock, чтобы схему применял только один экземпляр бота
+MIGRATION_LOCK_KEY = 727114
+
+# Состояние применения схемы, доступное обработчику health-check
+MIGRATION_STATE = {"status": "pending", "error": None}
+
+# Ссылка на фоновую задачу, чтобы ее не собрал сборщик мусора
+_migration_task: Optional[asyncio.Task] = None
+
+
+async def run_migrations(engine, raise_errors: bool = False) -> None:
+    """
+    Обновляет таблицы старой схемы и создает отсутствующие таблицы и индексы
+     под advisory lock.
+    Блокировка транзакционная и снимается автоматически при завершении транзакции.
+    Ошибка записывается в MIGRATION_STATE и логируется; в режиме sync она
+     пробрасывается дальше, чтобы бот не стартовал на несовместимой схеме.
+    :param engine: Асинхронный движок для выполнения операций с БД.
+    :param raise_errors: Пробросить ошибку после записи в MIGRATION_STATE.
+    """
+    logger.info("*БД* Вызвана функция run_migrations")
+    MIGRATION_STATE["status"] = "running"
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(
+                text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY}
+            )
+            # Сначала таблицы старой схемы получают столбцы, к которым обращаются
+            # запросы бота, затем создаются отсутствующие таблицы
+            await upgrade_tables_fast(conn)
+            await create_tables_fast(conn)
+        MIGRATION_STATE["status"] = "done"
+    except Exception as error:
+        MIGRATION_STATE["status"] = "failed"
+        MIGRATION_STATE["error"] = str(error)
+        logger.exception(f"*БД* Произошла ошибка в функции run_migrations: {error}")
+        if raise_errors:
+            raise
+
+
+async def start_migrations(engine, mode: str = MIGRATION_MODE) -> Optional[asyncio.Task]:
+    """
+    Применяет схему БД в соответствии с режимом MIGRATION_MODE.
+    Вызывается при старте бота.
+    :param engine: Асинхронный движок для выполнения операций с БД.
+    :param mode: Режим применения схемы: async, sync или skip.
+    :return: Фоновая задача в режиме async, иначе None.
+    :raises ValueError: Если режим не входит в MIGRATION_MODES.
+    :raises Exception: В режиме sync - ошибка применения схемы.
+    """
+    global _migration_task
+
+    if mode not in MIGRATION_MODES:
+        raise ValueError(
+            f"Неизвестный MIGRATION_MODE {mode!r}, допустимые значения: "
+            f"{', '.join(MIGRATION_MODES)}"
+        )
+    if mode == "skip":
+        MIGRATION_STATE["status"] = "skipped"
+        return None
+    if mode == "sync":
+        await run_migrations(engine, raise_errors=True)
+        return None
+
+    _migration_task = asyncio.create_task(run_migrations(engine))
+    return _migration_task
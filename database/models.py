@@ -1,8 +1,29 @@
-from sqlalchemy import Column, Integer, Boolean, String, ForeignKey, DateTime, Date
-from sqlalchemy.orm import declarative_base
-from sqlalchemy.orm import relationship
+from datetime import date, datetime
+from typing import Optional
 
-Base = declarative_base()
+from sqlalchemy import (
+    Integer,
+    Boolean,
+    String,
+    Text,
+    ForeignKey,
+    DateTime,
+    Date,
+    Index,
+    text,
+    false,
+    CheckConstraint,
+    func,
+)
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+# Длина telegram_id, общая для всех таблиц, чтобы типы столбцов в соединениях совпадали
+TELEGRAM_ID_LENGTH = 35
 
 
 class Users(Base):
@@ -21,9 +42,10 @@ class Users(Base):
     - referral_message_changed (bool): Флаг, указывающий, менял ли пользователь
       реферальное сообщение. True - менял, False - не менял.
     - referral_url (str): Реферальная ссылка пользователя
-
-    - info_ref_id (int): Внешний ключ для связи с таблицей ReferralInfo
-    - referral_info (ReferralInfo): Объект связи с таблицей ReferralInfo
+    - real_name (str): Реальное имя пользователя для приветственного сообщения рефералу
+    - user_url_for_message (str): Ссылка на пользователя для приветственного сообщения
+    - blocked_at (datetime): Когда рассылка обнаружила, что пользователь недоступен
+     (заблокировал бота или удален). None - пользователь доступен.
 
     - invitation_id (int): Внешний ключ для связи с таблицей Invitations
     - invitation (Invitations): Объект связи с таблицей Invitations
@@ -31,31 +53,44 @@ class Users(Base):
 
     __tablename__ = "users"
 
-    user_id = Column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
 
-    # telegram_id = Column(Integer, unique=True, nullable=False)
-    telegram_id = Column(String, unique=True, nullable=False)
+    telegram_id: Mapped[str] = mapped_column(
+        String(TELEGRAM_ID_LENGTH), unique=True, nullable=False
+    )
 
-    username = Column(String(35), nullable=True)
-    name = Column(String(130), nullable=True)
-    date_of_reg = Column(DateTime, nullable=False)
-    user_url = Column(String(50))
+    username: Mapped[Optional[str]] = mapped_column(String(35), nullable=True)
+    name: Mapped[Optional[str]] = mapped_column(String(130), nullable=True)
+    date_of_reg: Mapped[datetime] = mapped_column(
+        DateTime, nullable=False, server_default=func.now()
+    )
+    user_url: Mapped[Optional[str]] = mapped_column(String(50))
     # Флаг, указывающий, участвует ли пользователь в реф-ой программе
-    is_referral = Column(Boolean, default=False, nullable=False)
+    is_referral: Mapped[bool] = mapped_column(
+        Boolean, default=False, server_default=false(), nullable=False
+    )
     # Флаг, указывающий, менял ли пользователь реферальное сообщение
-    referral_message_changed = Column(Boolean, default=False, nullable=False)
-    referral_url = Column(String(100), nullable=False)
-
-    # Внешний ключ для связи (один к одному) с таблицей "ReferralInfo"
-    info_ref_id = Column(Integer, ForeignKey("referral_info.info_id"), nullable=True)
-    referral_info = relationship(
-        "ReferralInfo", backref="user", foreign_keys=[info_ref_id], uselist=False
+    referral_message_changed: Mapped[bool] = mapped_column(
+        Boolean, default=False, server_default=false(), nullable=False
     )
+    referral_url: Mapped[str] = mapped_column(Text, nullable=False)
+
+    # Информация для приветственного сообщения рефералу
+    real_name: Mapped[Optional[str]] = mapped_column(String(60), nullable=True)
+    user_url_for_message: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+
+    # Время, когда пользователь оказался недоступен для рассылки
+    blocked_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
 
     # Внешний ключ для связи с таблицей "Invitations"
-    invitation_id = Column(Integer, ForeignKey("invitations.id"), nullable=True)
-    invitation = relationship(
-        "Invitations", backref="user_invitation", foreign_keys=[invitation_id]
+    invitation_id: Mapped[Optional[int]] = mapped_column(
+        Integer, ForeignKey("invitations.id"), nullable=True, index=True
+    )
+    # Связь не загружается вместе с Users: запросы, которым она нужна, добавляют
+    # options(selectinload(Users.invitation)). Неявная подгрузка в async-сессии
+    # невозможна, поэтому обращение без загрузки сразу вызывает ошибку
+    invitation: Mapped[Optional["Invitations"]] = relationship(
+        back_populates="user_invitation", foreign_keys=[invitation_id], lazy="raise"
     )
 
 
@@ -67,32 +102,22 @@ class Invitations(Base):
     - id (int): Уникальный идентификатор записи
     - referrer (str): Telegram ID реферера (тот кто пригласил)
     - referral (str): Telegram ID реферала (тот кого пригласили)
+    - user_invitation (list[Users]): Пользователи, связанные с записью
     """
 
     __tablename__ = "invitations"
+    # Составной индекс (referrer, referral): поиск рефералов реферера и проверка пары
+    # выполняются по индексу без обращения к таблице
+    __table_args__ = (Index("ix_inv_referrer_referral", "referrer", "referral"),)
 
-    id = Column(Integer, primary_key=True)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
 
-    referrer = Column(String, nullable=False)
-    referral = Column(String, nullable=False, unique=True)
-
-
-class ReferralInfo(Base):
-    """
-    Таблица с информацией для приветственного сообщения рефералу.
-
-    Атрибуты:
-    - info_id (int): Уникальный идентификатор записи
-    - real_name (str): Реальное имя пользователя для сообщения
-    - user_url_for_message (str): Ссылка на пользователя для сообщения
-    """
-
-    __tablename__ = "referral_info"
-
-    info_id = Column(Integer, primary_key=True)
+    referrer: Mapped[str] = mapped_column(String(TELEGRAM_ID_LENGTH), nullable=False)
+    referral: Mapped[str] = mapped_column(
+        String(TELEGRAM_ID_LENGTH), nullable=False, unique=True
+    )
 
-    real_name = Column(String(60), nullable=False)
-    user_url_for_message = Column(String(100), nullable=False)
+    user_invitation: Mapped[list["Users"]] = relationship(back_populates="invitation")
 
 
 class ContentPlan(Base):
@@ -105,13 +130,35 @@ class ContentPlan(Base):
     - message (str): Текст сообщения для рассылки.
     - media_path (str): Путь к файлу для рассылки.
     - publish_date (date): Дата, когда сообщение должно отправиться.
+    - sent (bool): Флаг, указывающий, разослано ли сообщение. True - разослано.
     """
 
     __tablename__ = "content_plan"
+    # Таблица не партиционируется по publish_date: записи с прошедшей датой удаляются
+    # перед каждой рассылкой (get_old_paths_content_plan), поэтому в ней хранится
+    # только актуальный контент-план, а выборки идут по индексам ниже.
+    __table_args__ = (
+        # У пользователя может быть только одно сообщение на дату
+        Index("ix_cp_tgid_pubdate", "telegram_id", "publish_date", unique=True),
+        # Индекс для удаления сообщений с прошедшей датой
+        Index("ix_cp_publish_date", "publish_date"),
+        # Частичный индекс по еще не разосланным сообщениям для ежедневной рассылки
+        Index(
+            "ix_cp_pending_date", "publish_date", postgresql_where=text("sent = false")
+        ),
+        # Ограничение Telegram на длину текста сообщения
+        CheckConstraint("char_length(message) <= 4096", name="ck_cp_message_length"),
+    )
 
-    content_id = Column(Integer, primary_key=True)
+    content_id: Mapped[int] = mapped_column(Integer, primary_key=True)
 
-    telegram_id = Column(String(35), unique=False, nullable=False)
-    message = Column(String(1200), nullable=False)
-    media_path = Column(String(400), nullable=True)
-    publish_date = Column(Date, nullable=False)
+    telegram_id: Mapped[str] = mapped_column(
+        String(TELEGRAM_ID_LENGTH), unique=False, nullable=False
+    )
+    message: Mapped[str] = mapped_column(Text, nullable=False)
+    media_path: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    publish_date: Mapped[date] = mapped_column(Date, nullable=False)
+    # Флаг, указывающий, разослано ли сообщение рефералам
+    sent: Mapped[bool] = mapped_column(
+        Boolean, default=False, server_default=false(), nullable=False
+    )
@@ -1,21 +1,55 @@
 from datetime import datetime, timedelta, date
-from collections import defaultdict
-from typing import Optional
+from typing import AsyncIterator, Optional
 
-from database.models import Users, ReferralInfo, Invitations, ContentPlan
+from database.models import Users, Invitations, ContentPlan
+from database.sessions import session_scope, transaction_scope
+from database.writers import add_user, add_invitation, set_user_invitation
 from logging_errors.logging_setup import logger
 
-from sqlalchemy import select, exists, cast, delete
-from sqlalchemy.orm import selectinload
+from sqlalchemy import (
+    bindparam,
+    select,
+    exists,
+    cast,
+    delete,
+    update,
+    func,
+    any_,
+    literal,
+    Date,
+    Integer,
+    String,
+    Text,
+)
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
 from sqlalchemy.sql.expression import and_
 
+# Первым аргументом функции принимают фабрику сессий (async_session) или уже
+# открытую AsyncSession, например из DbSessionMiddleware (см. database.sessions).
+# Функции чтения check_user_in_db, get_all_telegram_ids, iter_all_telegram_ids,
+# get_user_url, get_date_of_reg, get_user_basic, get_content_plan_messages и
+# get_telegram_ids_content_by_date не перехватывают ошибки: их обрабатывает
+# обработчик бота (utils.middlewares.db_guard).
+
+# Часто вызываемые запросы собираются один раз при импорте модуля,
+# значения подставляются через bindparam
+_Q_CHECK_USER = select(exists().where(Users.telegram_id == bindparam("tg")))
+_Q_ALL_TG_IDS = select(Users.telegram_id)
+_Q_USER_URL = select(Users.user_url).where(Users.telegram_id == bindparam("tg"))
+_Q_DATE_OF_REG = select(Users.date_of_reg).where(
+    Users.telegram_id == bindparam("tg")
+)
+_Q_REFERRAL_MESSAGE_CHANGED = select(Users.referral_message_changed).where(
+    Users.telegram_id == bindparam("tg")
+)
+
 
 async def create_user(
     session_maker,
     telegram_id: str,
     username: str,
     name: str,
-    date_of_reg: datetime,
+    date_of_reg: Optional[datetime],
     user_url: str,
     referral_url: str,
     referrer_id: str,
@@ -27,41 +61,42 @@ async def create_user(
     - telegram_id (str): ID пользователя в Telegram.
     - username (str): логин пользователя в Telegram.
     - name (str): имя пользователя.
-    - date_of_reg (datetime): дата добавления пользователя в таблицу Users.
+    - date_of_reg (datetime | None): дата добавления пользователя в таблицу Users.
+     Если None, дату проставляет БД в момент вставки.
     - user_url (str): ссылка на пользователя.
     - referral_url (str): реферальная ссылка пользователя.
     - referrer_id (str): ID реферера.
 
     Примечания:
-    - Проверяет существование пользователя в базе данных по telegram_id.
-    - Если пользователь не существует, создает нового пользователя и его реферальную связь.
-    - Если пользователь уже существует, выводит сообщение 'ТАКОЙ ПОЛЬЗОВАТЕЛЬ УЖЕ ЕСТЬ В БД'.
+    - Пользователь добавляется через INSERT ... ON CONFLICT DO NOTHING, без
+     предварительной проверки существования.
+    - Реферальная связь создается, только если пользователь действительно добавлен.
 
     Возвращает:
-    - True - если пользователь создан.
+    - True - если пользователь создан или уже был в БД.
     При ошибке - None.
     """
     logger.info("*БД* Вызвана функция create_user")
     try:
-        async with session_maker() as session:
-            async with session.begin():
-                # Проверка существования пользователя в базе данных
-                user_exists = await check_user_in_db(session_maker, telegram_id)
-
-                if not user_exists:
-                    # Создание нового пользователя и его реферальной связи
-                    new_user = Users(
-                        telegram_id=telegram_id,
-                        username=username,
-                        name=name,
-                        date_of_reg=date_of_reg,
-                        user_url=user_url,
-                        referral_url=referral_url,
-                        invitation=Invitations(
-                            referrer=referrer_id, referral=telegram_id
-                        ),
+        async with session_scope(session_maker) as session:
+            async with transaction_scope(session):
+                user_id = await add_user(
+                    session,
+                    telegram_id=telegram_id,
+                    username=username,
+                    name=name,
+                    date_of_reg=date_of_reg,
+                    user_url=user_url,
+                    referral_url=referral_url,
+                )
+
+                # user_id is None - пользователь уже есть в БД
+                if user_id is not None:
+                    # Создание реферальной связи нового пользователя
+                    invitation_id = await add_invitation(
+                        session, referrer=referrer_id, referral=telegram_id
                     )
-                    session.add(new_user)
+                    await set_user_invitation(session, user_id, invitation_id)
                 return True
     except Exception as error:
         logger.exception(f"*БД* Произошла ошибка в функции create_user: {error}")
@@ -72,7 +107,7 @@ async def create_user_non_referrer(
     telegram_id: str,
     username: str,
     name: str,
-    date_of_reg: datetime,
+    date_of_reg: Optional[datetime],
     user_url: str,
     referral_url: str,
 ) -> None:
@@ -81,24 +116,18 @@ async def create_user_non_referrer(
     """
     logger.info("*БД* Вызвана функция create_user_non_referrer")
     try:
-        async with session_maker() as session:
-            async with session.begin():
-                # Проверка существования пользователя в базе данных
-                user_exists = await check_user_in_db(session_maker, telegram_id)
-
-                if not user_exists:
-                    # Создание нового пользователя
-                    new_user = Users(
-                        telegram_id=telegram_id,
-                        username=username,
-                        name=name,
-                        date_of_reg=date_of_reg,
-                        user_url=user_url,
-                        referral_url=referral_url,
-                    )
-
-                    session.add(new_user)
-                else:
+        async with session_scope(session_maker) as session:
+            async with transaction_scope(session):
+                user_id = await add_user(
+                    session,
+                    telegram_id=telegram_id,
+                    username=username,
+                    name=name,
+                    date_of_reg=date_of_reg,
+                    user_url=user_url,
+                    referral_url=referral_url,
+                )
+                if user_id is None:
                     print("ПОЛЬЗОВАТЕЛЬ УЖЕ ЕСТЬ В БД")
     except Exception as error:
         logger.exception(
@@ -106,7 +135,7 @@ async def create_user_non_referrer(
         )
 
 
-async def check_user_in_db(session_maker, telegram_id: str) -> Optional[bool]:
+async def check_user_in_db(session_maker, telegram_id: str) -> bool:
     """
     Проверяет наличие пользователя в таблице Users по telegram_id.
 
@@ -115,18 +144,13 @@ async def check_user_in_db(session_maker, telegram_id: str) -> Optional[bool]:
 
     Возвращает:
     - True, если пользователь с заданным telegram_id существует в БД, иначе False.
-    При ошибке - None.
+    Ошибки БД не перехватываются (см. utils.middlewares.db_guard).
     """
     if telegram_id in ["", None]:
         return False
     logger.info("*БД* Вызвана функция check_user_in_db")
-    try:
-        async with session_maker() as session:
-            query = select(exists().where(Users.telegram_id == telegram_id))
-            user_exists = await session.scalar(query)
-            return user_exists
-    except Exception as error:
-        logger.exception(f"*БД* Произошла ошибка в функции check_user_in_db: {error}")
+    async with session_scope(session_maker) as session:
+        return await session.scalar(_Q_CHECK_USER, {"tg": telegram_id})
 
 
 async def get_referrer_id(session_maker, telegram_id: str) -> Optional[str] | False:
@@ -143,7 +167,7 @@ async def get_referrer_id(session_maker, telegram_id: str) -> Optional[str] | Fa
 
     logger.info("*БД* Вызвана функция get_referrer_id")
     try:
-        async with session_maker() as session:
+        async with session_scope(session_maker) as session:
             query = select(Invitations.referrer).where(
                 Invitations.referral == telegram_id
             )
@@ -156,6 +180,54 @@ async def get_referrer_id(session_maker, telegram_id: str) -> Optional[str] | Fa
         return False
 
 
+def _referrals_cte(telegram_ids: list[str], only_unchanged: bool = False):
+    """
+    Строит рекурсивный CTE с рефералами всех уровней пользователей.
+    Обход дерева продолжается только через рефералов, которые не меняли
+     приветственное сообщение.
+
+    Параметры:
+    - telegram_ids (list[str]): ID пользователей в Telegram (корни деревьев).
+    - only_unchanged (bool): Если True, в CTE попадают только рефералы,
+     не менявшие приветственное сообщение.
+
+    Возвращает:
+    - CTE со столбцами owner (telegram_id корня дерева), referral (telegram_id
+     реферала), referral_message_changed, user_url и blocked_at.
+    """
+    base = (
+        select(
+            Invitations.referrer.label("owner"),
+            Invitations.referral,
+            Users.referral_message_changed,
+            Users.user_url,
+            Users.blocked_at,
+        )
+        .join(Users, Users.telegram_id == Invitations.referral)
+        .where(Invitations.referrer.in_(telegram_ids))
+    )
+    if only_unchanged:
+        base = base.where(Users.referral_message_changed.is_(False))
+    referrals = base.cte(name="referrals", recursive=True)
+
+    parent = referrals.alias("parent")
+    recursive = (
+        select(
+            parent.c.owner,
+            Invitations.referral,
+            Users.referral_message_changed,
+            Users.user_url,
+            Users.blocked_at,
+        )
+        .join(Users, Users.telegram_id == Invitations.referral)
+        .join(parent, Invitations.referrer == parent.c.referral)
+        .where(parent.c.referral_message_changed.is_(False))
+    )
+    if only_unchanged:
+        recursive = recursive.where(Users.referral_message_changed.is_(False))
+    return referrals.union_all(recursive)
+
+
 async def find_all_referral_telegram_id(session_maker, telegram_id: str) -> list[str]:
     """
     Ищет telegram_id рефералов всех уровней пользователя по telegram_id. \
@@ -179,30 +251,57 @@ async def find_all_referral_telegram_id(session_maker, telegram_id: str) -> list
     """
     logger.info("*БД* Вызвана функция find_all_referral_telegram_id")
     try:
-        async with session_maker() as session:
-            referrals = []
-            stack = [telegram_id]
+        async with session_scope(session_maker) as session:
+            # Все уровни дерева рефералов за один рекурсивный запрос
+            referrals = _referrals_cte([telegram_id])
+            result = await session.execute(select(referrals.c.referral))
+            return list(result.scalars())
+    except Exception as error:
+        logger.exception(
+            f"*БД* Произошла ошибка в find_all_referral_telegram_id create_user: {error}"
+        )
 
-            while stack:
-                referrer_id = stack.pop()
-                query = (
-                    select(Users)
-                    .join(Invitations, Users.telegram_id == Invitations.referral)
-                    .where(Invitations.referrer == referrer_id)
-                )
-                result = await session.execute(query)
 
-                for user in result.scalars():
-                    if user.referral_message_changed:
-                        referrals.append(user.telegram_id)
-                    else:
-                        referrals.append(user.telegram_id)
-                        stack.append(user.telegram_id)
+async def find_referrals_by_owner_ids(
+    session_maker, telegram_ids: list[str]
+) -> dict[str, list[str]]:
+    """
+    Ищет telegram_id рефералов всех уровней сразу для нескольких пользователей.
+    Условия обхода такие же, как в find_all_referral_telegram_id.
 
-            return referrals
+    Параметры:
+    - telegram_ids (list[str]): ID пользователей в Telegram.
+
+    Примечания:
+    - Все деревья обходятся одним рекурсивным запросом, столбец owner указывает,
+     к чьему дереву относится реферал. Заменяет вызов
+     find_all_referral_telegram_id в цикле по пользователям.
+    - Рефералы, недоступные для рассылки (blocked_at задан), в словарь не попадают,
+     но обход дерева через них продолжается.
+
+    Возвращает:
+    - Словарь вида {telegram_id: [telegram_id рефералов]}. Пользователи без
+     рефералов в словарь не попадают.
+    При ошибке - None.
+    """
+    logger.info("*БД* Вызвана функция find_referrals_by_owner_ids")
+    if not telegram_ids:
+        return {}
+    try:
+        async with session_scope(session_maker) as session:
+            referrals = _referrals_cte(telegram_ids)
+            result = await session.execute(
+                select(referrals.c.owner, referrals.c.referral).where(
+                    referrals.c.blocked_at.is_(None)
+                )
+            )
+            referrals_by_owner = {}
+            for owner, referral in result:
+                referrals_by_owner.setdefault(owner, []).append(referral)
+            return referrals_by_owner
     except Exception as error:
         logger.exception(
-            f"*БД* Произошла ошибка в find_all_referral_telegram_id create_user: {error}"
+            f"*БД* Произошла ошибка в функции find_referrals_by_owner_ids: {error}"
         )
 
 
@@ -219,8 +318,12 @@ async def find_user_urls(session_maker, telegram_ids: list[str]) -> list[str]:
 
     logger.info("*БД* Вызвана функция find_user_urls")
     try:
-        async with session_maker() as session:
-            query = select(Users.user_url).where(Users.telegram_id.in_(telegram_ids))
+        async with session_scope(session_maker) as session:
+            # Один параметр-массив вместо IN (...) с параметром на каждый элемент:
+            # текст запроса не зависит от длины списка и переиспользуется из кэша
+            query = select(Users.user_url).where(
+                Users.telegram_id == any_(literal(telegram_ids, ARRAY(String)))
+            )
             result = await session.execute(query)
             user_urls = [row for row in result.scalars()]
             return user_urls
@@ -241,12 +344,11 @@ async def find_all_referral_user_urls(session_maker, telegram_id: str) -> list[s
 
     logger.info("*БД* Вызвана функция find_all_referral_user_urls")
     try:
-        # Ищем рефералов всех уровней для заданного telegram_id
-        referrals = await find_all_referral_telegram_id(session_maker, telegram_id)
-        # Ищем user_url рефералов
-        user_urls = await find_user_urls(session_maker, referrals)
-
-        return user_urls
+        async with session_scope(session_maker) as session:
+            # user_url рефералов всех уровней берется из того же рекурсивного запроса
+            referrals = _referrals_cte([telegram_id])
+            result = await session.execute(select(referrals.c.user_url))
+            return list(result.scalars())
     except Exception as error:
         logger.exception(
             f"*БД* Произошла ошибка в функции find_all_referral_user_urls: {error}"
@@ -270,26 +372,11 @@ async def find_all_referral_telegram_id_to_change_msg(
 
     logger.info("*БД* Вызвана функция find_all_referral_telegram_id_to_change_msg")
     try:
-        async with session_maker() as session:
-            # Список для хранения всех рефералов
-            referrals = []
-            # Список для обхода рефералов
-            stack = [telegram_id]
-
-            while stack:
-                referrer_id = stack.pop()
-                query = (
-                    select(Invitations)
-                    .join(Users, Invitations.referral == Users.telegram_id)
-                    .where(Invitations.referrer == referrer_id)
-                    .where(Users.referral_message_changed.is_(False))
-                )
-                result = await session.execute(query)
-
-                for invitation in result.scalars():
-                    referrals.append(invitation.referral)
-                    stack.append(invitation.referral)
-            return referrals
+        async with session_scope(session_maker) as session:
+            # Все уровни дерева рефералов за один рекурсивный запрос
+            referrals = _referrals_cte([telegram_id], only_unchanged=True)
+            result = await session.execute(select(referrals.c.referral))
+            return list(result.scalars())
     except Exception as error:
         logger.exception(
             f"*БД* Произошла ошибка в функции find_all_referral_telegram_id_to_change_msg:"
@@ -301,10 +388,8 @@ async def add_referral_info_for_message(
     session_maker, telegram_ids: list | str, real_name: str, user_url_for_message: str
 ) -> Optional[True]:
     """
-    Обновляет информацию о пользователях/ле в таблице ReferralInfo для заданного telegram_ids.
-    Если связь с таблицей ReferralInfo уже существует, обновляет поля
-     real_name и user_url_for_message.
-    Если связь отсутствует, создает новую запись в таблице ReferralInfo и связывает ее с Users.
+    Обновляет информацию для приветственного сообщения (поля real_name и
+     user_url_for_message таблицы Users) пользователей/ля с заданными telegram_ids.
 
     Параметры:
     - telegram_ids (list | str): Список|str ID пользователей/ля в Telegram
@@ -318,35 +403,20 @@ async def add_referral_info_for_message(
 
     logger.info("*БД* Вызвана функция add_referral_info_for_message")
     try:
-        async with session_maker() as session:
-            async with session.begin():
+        async with session_scope(session_maker) as session:
+            async with transaction_scope(session):
                 if isinstance(telegram_ids, str):
                     telegram_ids = [telegram_ids]
 
+                # Одно UPDATE для всех пользователей без загрузки ORM-объектов
                 query = (
-                    select(Users)
-                    .options(selectinload(Users.referral_info))
+                    update(Users)
                     .where(Users.telegram_id.in_(telegram_ids))
+                    .values(
+                        real_name=real_name, user_url_for_message=user_url_for_message
+                    )
                 )
-                users = await session.execute(query)
-                users = users.scalars().all()
-                for user in users:
-                    if user:
-                        referral_info = user.referral_info
-                        # Если есть связь с ReferralInfo, то обновляем данные в таблице ReferralInfo
-                        if referral_info:
-                            referral_info.real_name = real_name
-                            referral_info.user_url_for_message = user_url_for_message
-                        # Если связь с таблицей ReferralInfo отсутствует, создаем новую запись
-                        else:
-                            referral_info = ReferralInfo(
-                                real_name=real_name,
-                                user_url_for_message=user_url_for_message,
-                            )
-                            user.referral_info = referral_info
-                            session.add(referral_info)
-                    else:
-                        pass
+                await session.execute(query)
                 return True
     except Exception as error:
         logger.exception(
@@ -370,8 +440,8 @@ async def update_referral_message_changed(
 
     logger.info("*БД* Вызвана функция update_referral_message_changed")
     try:
-        async with session_maker() as session:
-            async with session.begin():
+        async with session_scope(session_maker) as session:
+            async with transaction_scope(session):
                 query = select(Users).where(Users.telegram_id == telegram_id)
                 user = await session.execute(query)
                 user = user.scalar_one_or_none()
@@ -398,7 +468,7 @@ async def get_referral_info_url_and_name(
 
     Возвращает:
     - Кортеж (referral_url: str, real_name: str) с user_url_for_message и real_name пользователя.
-    - Если у пользователя нет информации для сообщения в таблице ReferralInfo, то вернет
+    - Если у пользователя нет информации для сообщения, то вернет
     ('Ссылка неизвестна', 'Имя неизвестно').
     - Если пользователя нет в таблице Users, то вернет ('Реферера нет в БД', 'Реферера нет в БД').
     При ошибке - (None, None).
@@ -406,19 +476,16 @@ async def get_referral_info_url_and_name(
 
     logger.info("*БД* Вызвана функция get_referral_info_url_and_name")
     try:
-        async with session_maker() as session:
-            query = (
-                select(Users)
-                .where(Users.telegram_id == telegram_id)
-                .options(selectinload(Users.referral_info))
+        async with session_scope(session_maker) as session:
+            query = select(Users.user_url_for_message, Users.real_name).where(
+                Users.telegram_id == telegram_id
             )
             result = await session.execute(query)
-            user = result.scalar_one_or_none()
+            user = result.one_or_none()
             if user:
-                referral_info = user.referral_info
-                if referral_info:
-                    referral_url = referral_info.user_url_for_message
-                    real_name = referral_info.real_name
+                if user.user_url_for_message is not None:
+                    referral_url = user.user_url_for_message
+                    real_name = user.real_name
                 else:
                     referral_url = "Ссылка неизвестна"
                     real_name = "Имя неизвестно"
@@ -444,17 +511,36 @@ async def get_all_telegram_ids(session_maker) -> list[str]:
     """
 
     logger.info("*БД* Вызвана функция get_all_telegram_ids")
-    try:
-        async with session_maker() as session:
-            query = select(Users.telegram_id)
-            results = await session.execute(query)
-            telegram_ids = [result[0] for result in results]
+    async with session_scope(session_maker) as session:
+        return list(await session.scalars(_Q_ALL_TG_IDS))
 
-            return telegram_ids
-    except Exception as error:
-        logger.exception(
-            f"*БД* Произошла ошибка в функции get_all_telegram_ids: {error}"
-        )
+
+async def iter_all_telegram_ids(
+    session_maker, batch_size: int = 1000
+) -> AsyncIterator[str]:
+    """
+    Постранично отдает все telegram_id из таблицы Users.
+
+    Параметры:
+    - batch_size (int): Сколько строк за раз забирать с сервера.
+
+    Возвращает:
+    - Асинхронный итератор по telegram_id (str).
+
+    Примечания:
+    - Используется серверный курсор (session.stream + yield_per), в памяти
+     одновременно находится не больше batch_size строк. Подходит для рассылок
+     по всем пользователям вместо get_all_telegram_ids.
+    - Сессия держит соединение, пока итерация не закончится.
+    - Ошибки БД не перехватываются (см. utils.middlewares.db_guard).
+    """
+
+    logger.info("*БД* Вызвана функция iter_all_telegram_ids")
+    async with session_scope(session_maker) as session:
+        query = select(Users.telegram_id).execution_options(yield_per=batch_size)
+        result = await session.stream_scalars(query)
+        async for telegram_id in result:
+            yield telegram_id
 
 
 async def get_user_url(session_maker, telegram_id: str) -> str:
@@ -466,17 +552,12 @@ async def get_user_url(session_maker, telegram_id: str) -> str:
 
     Возвращает:
     - Строка с user_url (ссылка на пользователя).
+    Если пользователя нет в БД - None.
     """
 
     logger.info("*БД* Вызвана функция get_user_url")
-    try:
-        async with session_maker() as session:
-            query = select(Users).where(Users.telegram_id == telegram_id)
-            result = await session.execute(query)
-            user = result.scalar_one()
-            return user.user_url
-    except Exception as error:
-        logger.exception(f"*БД* Произошла ошибка в функции get_user_url: {error}")
+    async with session_scope(session_maker) as session:
+        return await session.scalar(_Q_USER_URL, {"tg": telegram_id})
 
 
 async def get_date_of_reg(session_maker, telegram_id: str) -> datetime:
@@ -488,17 +569,39 @@ async def get_date_of_reg(session_maker, telegram_id: str) -> datetime:
 
     Возвращает:
     - Объект datetime со временем и датой добавления пользователя в БД.
+    Если пользователя нет в БД - None.
     """
 
     logger.info("*БД* Вызвана функция get_date_of_reg")
-    try:
-        async with session_maker() as session:
-            query = select(Users).where(Users.telegram_id == telegram_id)
-            result = await session.execute(query)
-            user = result.scalar_one()
-            return user.date_of_reg
-    except Exception as error:
-        logger.exception(f"*БД* Произошла ошибка в функции get_date_of_reg: {error}")
+    async with session_scope(session_maker) as session:
+        return await session.scalar(_Q_DATE_OF_REG, {"tg": telegram_id})
+
+
+async def get_user_basic(
+    session_maker, telegram_id: str
+) -> tuple[str, datetime] | None:
+    """
+    Получает user_url (ссылка на пользователя) и date_of_reg (дата добавления в БД)
+     из таблицы Users по telegram_id одним запросом.
+    Используется вместо пары вызовов get_user_url и get_date_of_reg.
+
+    Параметры:
+    - telegram_id (str): ID пользователя в Telegram.
+
+    Возвращает:
+    - Кортеж (user_url: str, date_of_reg: datetime).
+    Если пользователя нет в БД - None.
+    Ошибки БД не перехватываются (см. utils.middlewares.db_guard).
+    """
+
+    logger.info("*БД* Вызвана функция get_user_basic")
+    async with session_scope(session_maker) as session:
+        query = select(Users.user_url, Users.date_of_reg).where(
+            Users.telegram_id == telegram_id
+        )
+        result = await session.execute(query)
+        row = result.one_or_none()
+        return tuple(row) if row else None
 
 
 async def get_telegram_ids_for_mailing(
@@ -526,25 +629,32 @@ async def get_telegram_ids_for_mailing(
     logger.info("*БД* Вызвана функция get_telegram_ids_for_mailing")
 
     try:
-        async with session_maker() as session:
+        async with session_scope(session_maker) as session:
             target_date = date.today() - timedelta(days=days_for_mailing)
             target_date_time = datetime.combine(target_date, datetime.min.time())
             date_today_time = datetime.combine(date.today(), datetime.min.time())
 
-            query = select(Users.telegram_id, Users.date_of_reg).where(
-                and_(
-                    Users.date_of_reg > target_date_time,
-                    Users.date_of_reg < date_today_time,
+            # Группировка по дате регистрации выполняется в БД:
+            # одна строка на день вместо строки на пользователя
+            reg_date = cast(Users.date_of_reg, Date)
+            query = (
+                select(
+                    reg_date.label("reg_date"),
+                    func.array_agg(Users.telegram_id).label("telegram_ids"),
+                )
+                .where(
+                    and_(
+                        Users.date_of_reg > target_date_time,
+                        Users.date_of_reg < date_today_time,
+                    )
                 )
+                .group_by(reg_date)
             )
             result = await session.execute(query)
 
-            telegram_ids = defaultdict(list)
-            for row in result:
-                count_days = (date.today() - row[1].date()).days
-                telegram_ids[count_days].append(row[0])
-
-            return dict(telegram_ids)
+            return {
+                (date.today() - row.reg_date).days: row.telegram_ids for row in result
+            }
 
     except Exception as error:
         logger.exception(
@@ -570,35 +680,28 @@ async def get_referral_message_changed(
 
     logger.info("*БД* Вызвана функция get_referral_message_changed")
     try:
-        async with session_maker() as session:
-            if await check_user_in_db(session_maker, telegram_id):
-                query = select(Users).where(Users.telegram_id == telegram_id)
-                result = await session.execute(query)
-                user = result.scalar_one()
-
-                return user.referral_message_changed
-            return False
+        async with session_scope(session_maker) as session:
+            # Если пользователя нет в БД, запрос вернет None
+            return bool(
+                await session.scalar(_Q_REFERRAL_MESSAGE_CHANGED, {"tg": telegram_id})
+            )
     except Exception as error:
         logger.exception(
             f"*БД* Произошла ошибка в функции get_referral_message_changed: {error}"
         )
 
 
-async def validate_date(value) -> bool:
+def validate_date(value) -> bool:
     """
-    Проверяет, что value является объектом date.
+    Проверяет, что value является объектом date (но не datetime).
 
     Параметры:
-    - date: Значение для проверки.
+    - value: Значение для проверки.
 
     Возвращает:
-    - True - если дата является объектом date, иначе False.
+    - True - если value является объектом date, иначе False.
     """
-    value_is_date = isinstance(value, date)
-    value_is_datetime = isinstance(value, datetime)
-    if not value_is_date or value_is_datetime:
-        return False
-    return True
+    return isinstance(value, date) and not isinstance(value, datetime)
 
 
 async def create_content_plan_message(
@@ -633,41 +736,40 @@ async def create_content_plan_message(
 
     logger.info("*БД* Вызвана функция create_content_plan_message")
     try:
-        async with session_maker() as session:
-            async with session.begin():
+        async with session_scope(session_maker) as session:
+            async with transaction_scope(session):
                 # # Проверка publish_date является объектом date
-                publish_date_is_date = await validate_date(publish_date)
-                print(publish_date_is_date)
+                publish_date_is_date = validate_date(publish_date)
                 if not publish_date_is_date:
                     return 1  # Код ошибки для неверного формата publish_date
 
-                # # Проверка существования пользователя в базе данных
-                user_exists = await check_user_in_db(session_maker, telegram_id)
-                if not user_exists:
-                    return 2  # Код ошибки для отсутствующего пользователя
-
-                # # Проверка существования сообщения с датой publish_date
-                query = select(
-                    exists().where(
-                        and_(
-                            ContentPlan.telegram_id == telegram_id,
-                            ContentPlan.publish_date == publish_date,
-                        )
+                # Сообщение создается одним запросом: INSERT ... SELECT вставляет
+                # строку, только если пользователь есть в Users, а дубликат на дату
+                # отсекается уникальным индексом (telegram_id, publish_date)
+                user_exists = exists().where(Users.telegram_id == telegram_id)
+                query = (
+                    pg_insert(ContentPlan)
+                    .from_select(
+                        ["telegram_id", "message", "publish_date", "media_path"],
+                        select(
+                            literal(telegram_id, String),
+                            literal(message, Text),
+                            literal(publish_date, Date),
+                            literal(media_path, Text),
+                        ).where(user_exists),
+                    )
+                    .on_conflict_do_nothing(
+                        index_elements=["telegram_id", "publish_date"]
                     )
                 )
-                message_date_exists = await session.scalar(query)
-                if message_date_exists:
-                    return 3  # Код ошибки для дубликата сообщения на эту дату
+                result = await session.execute(query)
+                if result.rowcount == 1:
+                    return 0
 
-                # Создание сообщения для контент-плана
-                new_message = ContentPlan(
-                    telegram_id=telegram_id,
-                    message=message,
-                    publish_date=publish_date,
-                    media_path=media_path,
-                )
-                session.add(new_message)
-                return 0
+                # Сообщение не создано: определяем причину
+                if not await session.scalar(select(user_exists)):
+                    return 2  # Код ошибки для отсутствующего пользователя
+                return 3  # Код ошибки для дубликата сообщения на эту дату
 
     except Exception as error:
         logger.exception(
@@ -692,23 +794,22 @@ async def get_content_plan_messages(session_maker, telegram_id: str) -> list[dic
     """
 
     logger.info("*БД* Вызвана функция get_content_plan_messages")
-    try:
-        async with session_maker() as session:
-            query = select(ContentPlan).where(ContentPlan.telegram_id == telegram_id)
-            result = await session.execute(query)
-            messages = []
-            for row in result.scalars():
-                message_data = {
-                    "message": row.message,
-                    "media_path": row.media_path,
-                    "publish_date": row.publish_date.strftime("%d.%m.%Y"),
-                }
-                messages.append(message_data)
-            return messages
-    except Exception as error:
-        logger.exception(
-            f"*БД* Произошла ошибка в функции get_content_plan_messages: {error}"
-        )
+    async with session_scope(session_maker) as session:
+        # Дата форматируется на стороне PostgreSQL, а не через strftime в Python
+        query = select(
+            ContentPlan.message,
+            ContentPlan.media_path,
+            func.to_char(ContentPlan.publish_date, "DD.MM.YYYY"),
+        ).where(ContentPlan.telegram_id == telegram_id)
+        result = await session.execute(query)
+        return [
+            {
+                "message": message,
+                "media_path": media_path,
+                "publish_date": publish_date,
+            }
+            for message, media_path, publish_date in result
+        ]
 
 
 async def delete_content_plan_message(
@@ -732,10 +833,10 @@ async def delete_content_plan_message(
     """
     logger.info("*БД* Вызвана функция delete_content_plan_message")
     try:
-        async with session_maker() as session:
-            async with session.begin():
+        async with session_scope(session_maker) as session:
+            async with transaction_scope(session):
                 # # Проверка publish_date является объектом date
-                publish_date_is_date = await validate_date(publish_date)
+                publish_date_is_date = validate_date(publish_date)
                 if not publish_date_is_date:
                     return 1  # Код ошибки для неверного формата publish_date
 
@@ -762,33 +863,130 @@ async def get_telegram_ids_content_by_date(session_maker) -> dict:
     """
     Получает словарь, где ключами являются telegram_id пользователей, рефералам
      которых нужно сегодня отправить рассылку по контент-плану, а значениями - сообщения.
+    Уже разосланные сообщения (sent=True) не попадают в словарь.
 
     Возвращает:
-    - Словарь вида {"telegram_id": {"message": str, "media_path": str | None}}, если сообщение
-    не содержит медиа, то media_path будет None.
+    - Словарь вида {"telegram_id": {"content_id": int, "message": str,
+     "media_path": str | None}}, если сообщение не содержит медиа, то media_path
+     будет None. content_id передается в mark_content_plan_sent.
     - Если нет сообщений для сегодняшней рассылки, вернёт {}.
     """
     logger.info("*БД* Вызвана функция get_telegram_ids_content_by_date")
-    try:
-        async with session_maker() as session:
-            date_today = date.today()
-            query = select(ContentPlan).where(ContentPlan.publish_date == date_today)
-            result = await session.execute(query)
+    async with session_scope(session_maker) as session:
+        date_today = date.today()
+        query = select(ContentPlan).where(
+            and_(
+                ContentPlan.publish_date == date_today,
+                ContentPlan.sent.is_(False),
+            )
+        )
+        result = await session.execute(query)
 
-            messages = {}
-            for row in result.scalars():
-                messages[row.telegram_id] = {
-                    "message": row.message,
-                    "media_path": row.media_path,
-                }
-            return messages
+        messages = {}
+        for row in result.scalars():
+            messages[row.telegram_id] = {
+                "content_id": row.content_id,
+                "message": row.message,
+                "media_path": row.media_path,
+            }
+        return messages
 
+
+async def mark_content_plan_sent(session_maker, content_ids: list[int]) -> None:
+    """
+    Отмечает разосланные сообщения контент-плана.
+
+    Параметры:
+    - content_ids (list[int]): список content_id разосланных сообщений из
+     get_telegram_ids_content_by_date.
+
+    Примечания:
+    - Записи отмечаются по content_id, а не по текущей дате: рассылка, которая
+     закончилась после полуночи, отмечает именно те сообщения, которые отправила.
+    """
+    logger.info("*БД* Вызвана функция mark_content_plan_sent")
+    if not content_ids:
+        return
+    try:
+        async with session_scope(session_maker) as session:
+            async with transaction_scope(session):
+                query = (
+                    update(ContentPlan)
+                    .where(
+                        ContentPlan.content_id
+                        == any_(literal(content_ids, ARRAY(Integer)))
+                    )
+                    .values(sent=True)
+                )
+                await session.execute(query)
     except Exception as error:
         logger.exception(
-            f"*БД* Произошла ошибка в функции get_telegram_ids_content_by_date: {error}"
+            f"*БД* Произошла ошибка в функции mark_content_plan_sent: {error}"
         )
 
 
+async def mark_users_blocked(session_maker, telegram_ids: list[str]) -> None:
+    """
+    Отмечает пользователей, недоступных для рассылки (заблокировали бота,
+     удалены или чат не найден), одним UPDATE.
+
+    Параметры:
+    - telegram_ids (list[str]): список ID пользователей в Telegram.
+
+    Примечания:
+    - blocked_at уже отмеченных пользователей не меняется.
+    - Список передается в запрос одним параметром-массивом (= ANY), поэтому
+     его размер не влияет на текст запроса.
+    """
+    logger.info("*БД* Вызвана функция mark_users_blocked")
+    if not telegram_ids:
+        return
+    try:
+        async with session_scope(session_maker) as session:
+            async with transaction_scope(session):
+                query = (
+                    update(Users)
+                    .where(
+                        and_(
+                            Users.telegram_id
+                            == any_(literal(telegram_ids, ARRAY(String))),
+                            Users.blocked_at.is_(None),
+                        )
+                    )
+                    .values(blocked_at=func.now())
+                )
+                await session.execute(query)
+    except Exception as error:
+        logger.exception(f"*БД* Произошла ошибка в функции mark_users_blocked: {error}")
+
+
+async def unblock_user(session_maker, telegram_id: str) -> None:
+    """
+    Снимает отметку недоступности (blocked_at) с пользователя, чтобы он снова
+     получал рассылку. Вызывается, когда пользователь снова пишет боту.
+
+    Параметры:
+    - telegram_id (str): ID пользователя в Telegram.
+    """
+    logger.info("*БД* Вызвана функция unblock_user")
+    try:
+        async with session_scope(session_maker) as session:
+            async with transaction_scope(session):
+                query = (
+                    update(Users)
+                    .where(
+                        and_(
+                            Users.telegram_id == telegram_id,
+                            Users.blocked_at.is_not(None),
+                        )
+                    )
+                    .values(blocked_at=None)
+                )
+                await session.execute(query)
+    except Exception as error:
+        logger.exception(f"*БД* Произошла ошибка в функции unblock_user: {error}")
+
+
 async def get_old_paths_content_plan(session_maker) -> list[str]:
     """
     Получает список путей к файлам контент-плана и удаляет записи из таблицы ContentPlan,
@@ -799,19 +997,17 @@ async def get_old_paths_content_plan(session_maker) -> list[str]:
     """
     logger.info("*БД* Вызвана функция get_old_paths_content_plan")
     try:
-        async with session_maker() as session:
-            # Получаем записи, у которых publish_date раньше сегодняшней даты
-            query = select(ContentPlan).where(ContentPlan.publish_date < date.today())
-            result = await session.execute(query)
-            old_content_plans = result.scalars().all()
-
-            # Удаляем найденные записи и записываем media_path перед удалением
-            deleted_media_paths = []
-            for content_plan in old_content_plans:
-                if content_plan.media_path:
-                    deleted_media_paths.append(content_plan.media_path)
-                await session.delete(content_plan)
-            await session.commit()
+        async with session_scope(session_maker) as session:
+            async with transaction_scope(session):
+                # Удаляем записи, у которых publish_date раньше сегодняшней даты,
+                # и получаем их media_path одним запросом
+                query = (
+                    delete(ContentPlan)
+                    .where(ContentPlan.publish_date < date.today())
+                    .returning(ContentPlan.media_path)
+                )
+                result = await session.execute(query)
+                deleted_media_paths = [path for path in result.scalars() if path]
 
         return deleted_media_paths
     except Exception as error:
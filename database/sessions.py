@@ -0,0 +1,78 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Ключи session.info: сессия передана функциям БД снаружи (ее транзакцией
+# управляет владелец) и в ней произошла ошибка запроса (владелец должен откатить
+# транзакцию, а не фиксировать ее)
+BORROWED_KEY = "borrowed"
+FAILED_KEY = "failed"
+
+
+@asynccontextmanager
+async def session_scope(session_or_maker) -> AsyncIterator[AsyncSession]:
+    """
+    Отдает сессию для функций БД.
+
+    Параметры:
+    - session_or_maker: Фабрика сессий (async_sessionmaker) или уже открытая
+     AsyncSession.
+
+    Примечания:
+    - Если передана фабрика, открывается новая сессия и закрывается на выходе.
+    - Если передана открытая сессия (например, из DbSessionMiddleware или
+     рассылки), она используется как есть, не закрывается и отмечается как
+     чужая (BORROWED_KEY): запросы выполняются в транзакции владельца, без
+     SAVEPOINT, а фиксирует ее только владелец.
+    - Ошибка запроса прерывает транзакцию PostgreSQL целиком, поэтому в чужой
+     сессии транзакция сразу откатывается, а сессия отмечается FAILED_KEY:
+     владелец не должен фиксировать оставшуюся часть изменений.
+    """
+    if isinstance(session_or_maker, AsyncSession):
+        session = session_or_maker
+        session.info[BORROWED_KEY] = True
+        try:
+            yield session
+        except Exception:
+            session.info[FAILED_KEY] = True
+            await session.rollback()
+            raise
+    else:
+        async with session_or_maker() as session:
+            yield session
+
+
+def session_failed(session: AsyncSession) -> bool:
+    """
+    Возвращает True, если в сессии произошла ошибка запроса и ее изменения
+     были откатаны (см. session_scope).
+    """
+    return session.info.get(FAILED_KEY, False)
+
+
+@asynccontextmanager
+async def transaction_scope(session: AsyncSession) -> AsyncIterator[AsyncSession]:
+    """
+    Открывает транзакцию для изменяющих запросов.
+
+    Примечания:
+    - В чужой сессии (BORROWED_KEY) транзакция не фиксируется: изменения
+     отправляются в БД через flush внутри транзакции владельца (она начинается
+     автоматически), а commit или rollback выполняет владелец. Поэтому
+     обработчик атомарен независимо от порядка чтений и записей.
+    - В собственной сессии без активной транзакции выполняется session.begin()
+     и изменения фиксируются на выходе.
+    - Если в собственной сессии транзакция уже идет, используется SAVEPOINT
+     (begin_nested).
+    """
+    if session.info.get(BORROWED_KEY):
+        yield session
+        # Ошибки изменений ORM-объектов возникают здесь, внутри функции БД
+        await session.flush()
+    elif session.in_transaction():
+        async with session.begin_nested():
+            yield session
+    else:
+        async with session.begin():
+            yield session
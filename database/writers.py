@@ -0,0 +1,77 @@
+from typing import Optional
+
+from sqlalchemy import insert, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.models import Users, Invitations
+
+
+async def add_user(session: AsyncSession, **fields) -> Optional[int]:
+    """
+    Добавляет пользователя в таблицу Users через Core INSERT, без создания ORM-объекта.
+    Транзакцией управляет вызывающая функция.
+
+    Параметры:
+    - fields: Значения столбцов таблицы Users. Если date_of_reg не передан или None,
+     дату регистрации проставляет БД (server_default now()).
+
+    Примечания:
+    - Выполняется INSERT ... ON CONFLICT (telegram_id) DO NOTHING, поэтому
+     отдельная проверка существования пользователя не нужна, а одновременная
+     регистрация одного пользователя не приводит к ошибке уникальности.
+
+    Возвращает:
+    - user_id созданного пользователя.
+    Если пользователь с таким telegram_id уже есть - None.
+    """
+    if fields.get("date_of_reg") is None:
+        fields.pop("date_of_reg", None)
+    query = (
+        pg_insert(Users)
+        .values(**fields)
+        .on_conflict_do_nothing(index_elements=[Users.telegram_id])
+        .returning(Users.user_id)
+    )
+    result = await session.execute(query)
+    return result.scalar_one_or_none()
+
+
+async def add_invitation(session: AsyncSession, referrer: str, referral: str) -> int:
+    """
+    Добавляет реферальную связь в таблицу Invitations через Core INSERT.
+    Транзакцией управляет вызывающая функция.
+
+    Параметры:
+    - referrer (str): Telegram ID реферера (тот кто пригласил).
+    - referral (str): Telegram ID реферала (тот кого пригласили).
+
+    Возвращает:
+    - id созданной записи.
+    """
+    query = (
+        insert(Invitations)
+        .values(referrer=referrer, referral=referral)
+        .returning(Invitations.id)
+    )
+    result = await session.execute(query)
+    return result.scalar_one()
+
+
+async def set_user_invitation(
+    session: AsyncSession, user_id: int, invitation_id: int
+) -> None:
+    """
+    Привязывает реферальную связь к пользователю (Users.invitation_id).
+    Транзакцией управляет вызывающая функция.
+
+    Параметры:
+    - user_id (int): user_id пользователя.
+    - invitation_id (int): id записи в таблице Invitations.
+    """
+    query = (
+        update(Users)
+        .where(Users.user_id == user_id)
+        .values(invitation_id=invitation_id)
+    )
+    await session.execute(query)
@@ -1 +1,4 @@
 from utils import mailing
+from utils import event_loop
+from utils import middlewares
+from utils import rate_limits
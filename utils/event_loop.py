@@ -0,0 +1,22 @@
+import asyncio
+
+from logging_errors.logging_setup import logger
+
+
+def install_uvloop() -> bool:
+    """
+    Устанавливает uvloop в качестве политики цикла событий asyncio.
+    Вызывается в точке входа бота до asyncio.run / executor.start_polling.
+
+    Возвращает:
+    - True - если uvloop установлен, False - если пакет uvloop недоступен
+     (используется стандартный цикл событий).
+    """
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("*ЦИКЛ* uvloop не установлен, используется стандартный цикл asyncio")
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
@@ -1,16 +1,328 @@
+import asyncio
+import os
+from collections import defaultdict
+from typing import Iterator, Optional
+
+import aiofiles.os
 from aiogram import types
 
-from aiogram.utils.exceptions import BotBlocked, ChatNotFound
+from aiogram.utils.exceptions import (
+    BotBlocked,
+    ChatNotFound,
+    RetryAfter,
+    UserDeactivated,
+)
 
 from create_bot import bot
 from database.engine import async_session
 from database.queries import (
     get_telegram_ids_content_by_date,
-    find_all_referral_telegram_id,
+    find_referrals_by_owner_ids,
     get_old_paths_content_plan,
+    mark_content_plan_sent,
+    mark_users_blocked,
 )
 
 from logging_errors.logging_setup import logger
+from utils.rate_limits import BROADCAST_LIMITER
+
+# Количество одновременных запросов к Telegram при рассылке: максимальное,
+# минимальное (до него предел снижается после RetryAfter) и шаг снижения
+MAILING_CONCURRENCY = 25
+MAILING_MIN_CONCURRENCY = 5
+MAILING_CONCURRENCY_STEP = 5
+
+# После скольких успешных отправок подряд предел увеличивается на 1
+MAILING_GROW_AFTER = 100
+
+# Сколько получателей может ждать отправки в очереди рассылки
+MAILING_QUEUE_SIZE = 1000
+
+# Сколько раз пробовать отправить сообщение, если Telegram отвечает RetryAfter
+MAILING_MAX_ATTEMPTS = 3
+
+# Сколько telegram_id недоступных получателей выводить в итоговом сообщении лога
+UNREACHABLE_LOG_SAMPLE = 20
+
+# Пока событие сброшено, все отправки рассылки ждут окончания паузы RetryAfter
+_SENDING_ALLOWED = asyncio.Event()
+_SENDING_ALLOWED.set()
+
+
+class _AdaptiveLimit:
+    """
+    Ограничение числа одновременных отправок с изменяемым пределом.
+
+    Примечания:
+    - Счетчик и предел защищены asyncio.Condition: в отличие от внутреннего
+     значения asyncio.Semaphore, предел можно безопасно менять во время рассылки.
+    - shrink() снижает предел на MAILING_CONCURRENCY_STEP (не ниже минимума)
+     после RetryAfter, success() возвращает по 1 после MAILING_GROW_AFTER
+     успешных отправок подряд.
+    """
+
+    def __init__(self, maximum: int, minimum: int):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = maximum
+        self.active = 0
+        self._successes = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            while self.active >= self.limit:
+                await self._condition.wait()
+            self.active += 1
+
+    async def release(self):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify(1)
+
+    async def shrink(self):
+        async with self._condition:
+            self._successes = 0
+            self.limit = max(self.minimum, self.limit - MAILING_CONCURRENCY_STEP)
+
+    async def success(self):
+        async with self._condition:
+            self._successes += 1
+            if self._successes >= MAILING_GROW_AFTER and self.limit < self.maximum:
+                self._successes = 0
+                self.limit += 1
+                self._condition.notify(1)
+
+
+# Предел одновременных отправок рассылки, снижается при RetryAfter
+_CONCURRENCY = _AdaptiveLimit(MAILING_CONCURRENCY, MAILING_MIN_CONCURRENCY)
+
+# Ссылка на фоновую задачу рассылки, чтобы ее не собрал сборщик мусора
+_mailing_task: Optional[asyncio.Task] = None
+
+# Тип медиа по расширению файла, остальные файлы отправляются документом
+_EXT_MAP = {
+    ".jpg": "photo",
+    ".jpeg": "photo",
+    ".png": "photo",
+    ".mp4": "video",
+    ".avi": "video",
+    ".mov": "video",
+}
+
+# Метод бота для каждого типа медиа, имя аргумента с медиа совпадает с типом
+_MEDIA_SENDERS = {
+    "photo": bot.send_photo,
+    "video": bot.send_video,
+    "document": bot.send_document,
+}
+
+
+async def _pause_sending(timeout: int):
+    """
+    Приостанавливает все отправки рассылки на timeout секунд после RetryAfter.
+    Если пауза уже идет (RetryAfter получил другой обработчик), ждет ее окончания.
+    """
+    if not _SENDING_ALLOWED.is_set():
+        await _SENDING_ALLOWED.wait()
+        return
+    logger.warning(f"*РАССЫЛКА* Лимит Telegram, пауза рассылки на {timeout} с")
+    _SENDING_ALLOWED.clear()
+    try:
+        await asyncio.sleep(timeout)
+    finally:
+        _SENDING_ALLOWED.set()
+
+
+async def _safe_rm(file_path: str):
+    """
+    Удаляет файл в пуле потоков (aiofiles), не блокируя цикл событий.
+    Отсутствующий файл не считается ошибкой, другие ошибки удаления логируются
+     и не прерывают рассылку (запись о файле в БД к этому моменту уже удалена).
+    """
+    try:
+        await aiofiles.os.remove(file_path)
+    except FileNotFoundError:
+        logger.debug(f"*РАССЫЛКА* Файл {file_path} не найден.")
+    except OSError as error:
+        logger.warning(f"*РАССЫЛКА* Не удалось удалить файл {file_path}: {error}")
+
+
+def _extract_file_id(sent_message: types.Message, media_type: str) -> str | None:
+    """
+    Достает file_id загруженного медиа из ответа Telegram.
+    Для фото берется самый большой размер (последний в списке).
+    """
+    if media_type == "photo":
+        return sent_message.photo[-1].file_id if sent_message.photo else None
+    media = getattr(sent_message, media_type, None)
+    return media.file_id if media else None
+
+
+async def _send_media(
+    telegram_id: str, message: str, media: types.InputFile | str, media_type: str
+) -> types.Message:
+    """
+    Отправляет медиа (InputFile или file_id) с подписью с учетом BROADCAST_LIMITER.
+    """
+    send = _MEDIA_SENDERS[media_type]
+    async with BROADCAST_LIMITER:
+        return await send(chat_id=telegram_id, caption=message, **{media_type: media})
+
+
+async def _deliver(
+    telegram_id: str,
+    message: str,
+    media_path: str | None,
+    media_type: str | None,
+    file_ids: dict[str, str],
+    upload_locks: defaultdict[str, asyncio.Lock],
+):
+    """
+    Выполняет один запрос отправки к Telegram с учетом BROADCAST_LIMITER.
+
+    Примечания:
+    - Медиафайл загружается в Telegram один раз за рассылку: первая отправка
+     идет с InputFile под upload_locks[media_path], из ответа сохраняется file_id
+     в file_ids, остальные получатели получают файл по file_id без повторной
+     загрузки.
+    - Если первая отправка не удалась (например, бот заблокирован), файл
+     загружает следующий получатель.
+    """
+    if not media_type:
+        # Отправка сообщения без медиа
+        async with BROADCAST_LIMITER:
+            await bot.send_message(chat_id=telegram_id, text=message)
+        return
+
+    file_id = file_ids.get(media_path)
+    if file_id is None:
+        async with upload_locks[media_path]:
+            file_id = file_ids.get(media_path)
+            if file_id is None:
+                sent_message = await _send_media(
+                    telegram_id, message, types.InputFile(media_path), media_type
+                )
+                file_id = _extract_file_id(sent_message, media_type)
+                if file_id:
+                    file_ids[media_path] = file_id
+                return
+
+    await _send_media(telegram_id, message, file_id, media_type)
+
+
+async def _send_content(
+    telegram_id: str,
+    message: str,
+    media_path: str | None,
+    media_type: str | None,
+    file_ids: dict[str, str],
+    upload_locks: defaultdict[str, asyncio.Lock],
+) -> bool:
+    """
+    Отправляет одно сообщение рассылки пользователю.
+
+    Параметры:
+    - telegram_id (str): ID получателя в Telegram.
+    - message (str): Текст сообщения (подпись к медиа).
+    - media_path (str | None): Путь к медиафайлу.
+    - media_type (str | None): photo, video, document или None для текста.
+    - file_ids, upload_locks: Общие для рассылки file_id загруженных медиафайлов
+     и блокировки их загрузки (см. _deliver).
+
+    Примечания:
+    - Если Telegram ответил RetryAfter, вся рассылка приостанавливается на
+     указанное время (_pause_sending), затем сообщение отправляется повторно,
+     всего не больше MAILING_MAX_ATTEMPTS попыток. Предел одновременных
+     отправок (_CONCURRENCY) при этом снижается.
+
+    Возвращает:
+    - False, если получатель недоступен (заблокировал бота, удален или чат не
+     найден), иначе True.
+    """
+    args = (telegram_id, message, media_path, media_type, file_ids, upload_locks)
+    try:
+        for attempt in range(1, MAILING_MAX_ATTEMPTS + 1):
+            await _SENDING_ALLOWED.wait()
+            try:
+                await _deliver(*args)
+                await _CONCURRENCY.success()
+                break
+            except RetryAfter as error:
+                await _CONCURRENCY.shrink()
+                if attempt == MAILING_MAX_ATTEMPTS:
+                    raise
+                await _pause_sending(error.timeout)
+    except FileNotFoundError:
+        logger.debug(f"*РАССЫЛКА* Не найден файл: {media_path}")
+    except (BotBlocked, ChatNotFound, UserDeactivated) as error:
+        logger.info(f"*РАССЫЛКА* Получатель {telegram_id} недоступен: {error}")
+        return False
+    except Exception as error:
+        logger.exception(
+            f"*РАССЫЛКА* Не удалось отправить сообщение {telegram_id}: {error}"
+        )
+    return True
+
+
+def _iter_recipients(
+    users_with_content: dict, referrals_by_owner: dict[str, list[str]]
+) -> Iterator[tuple[str, str, str | None, str | None]]:
+    """
+    Отдает по одному получателю рассылки: (telegram_id, message, media_path,
+     media_type).
+
+    Примечания:
+    - Реферал может входить в деревья нескольких пользователей, каждый
+     получатель получает только первое подходящее сообщение.
+    - Если медиафайл записи не найден, запись пропускается целиком.
+    """
+    seen_telegram_ids = set()
+
+    for owner_id, content in users_with_content.items():
+        telegram_ids = referrals_by_owner.get(owner_id)
+        if not telegram_ids:
+            continue
+        message = content["message"]
+        media_path = content["media_path"]
+
+        if media_path:
+            media_extension = os.path.splitext(media_path)[1].lower()
+            media_type = _EXT_MAP.get(media_extension, "document")
+        else:
+            media_type = None
+
+        # Файл проверяется один раз на запись, а не на каждого получателя
+        if media_type and not os.path.isfile(media_path):
+            logger.debug(f"*РАССЫЛКА* Не найден файл: {media_path}")
+            continue
+
+        for telegram_id in telegram_ids:
+            if telegram_id in seen_telegram_ids:
+                continue
+            seen_telegram_ids.add(telegram_id)
+            yield telegram_id, message, media_path, media_type
+
+
+async def _mailing_worker(
+    queue: asyncio.Queue,
+    file_ids: dict[str, str],
+    upload_locks: defaultdict[str, asyncio.Lock],
+    unreachable: list[str],
+):
+    """
+    Забирает получателей из очереди и отправляет им сообщения, пока его не отменят.
+    telegram_id недоступных получателей добавляются в unreachable.
+    """
+    while True:
+        recipient = await queue.get()
+        await _CONCURRENCY.acquire()
+        try:
+            if not await _send_content(*recipient, file_ids, upload_locks):
+                unreachable.append(recipient[0])
+        finally:
+            await _CONCURRENCY.release()
+            queue.task_done()
 
 
 async def send_content_to_referrals():
@@ -19,81 +331,113 @@ async def send_content_to_referrals():
     """
     logger.info("*РАССЫЛКА* Вызвана функция send_content_to_referrals")
     try:
-        # Удаление старых файлов и записей из БД
-        old_file_path = await get_old_paths_content_plan(async_session)
-        for file_path in old_file_path:
+        # Одна сессия на всю рассылку: запросы не берут соединение из пула заново
+        async with async_session() as session:
+            # Удаление старых файлов и записей из БД
+            old_file_path = await get_old_paths_content_plan(session)
+            # Функции БД не фиксируют изменения в переданной сессии: удаление
+            # записей фиксируется до удаления файлов, на которые они ссылались
+            await session.commit()
+            # Файлы удаляются в пуле потоков, пока выполняются следующие запросы
+            # к БД (запросы одной сессии параллельно выполнять нельзя)
+            cleanup = asyncio.gather(
+                *(_safe_rm(path) for path in old_file_path or []),
+                return_exceptions=True,
+            )
             try:
-                os.remove(file_path)
-            except FileNotFoundError:
-                logger.debug(f"*РАССЫЛКА* Файл {file_path} не найден.")
-                continue
+                # Получаем словарь с telegram_id чьим рефералам нужно сегодня
+                # отправить рассылку и данными для сообщения
+                users_with_content = await get_telegram_ids_content_by_date(session)
+
+                # Рефералы всех пользователей с контентом одним запросом
+                referrals_by_owner = await find_referrals_by_owner_ids(
+                    session, list(users_with_content)
+                )
 
-        # Получаем словарь с telegram_id чьим рефералам нужно сегодня отправить
-        # рассылку и данными для сообщения
-        users_with_content = await get_telegram_ids_content_by_date(async_session)
+                # Завершаем читающую транзакцию, чтобы соединение не простаивало
+                # в транзакции (idle in transaction) во время отправки сообщений
+                await session.commit()
+            finally:
+                # Удаление файлов дожидаемся и при ошибке запросов, чтобы не
+                # оставлять незавершенные задачи
+                for result in await cleanup:
+                    if isinstance(result, BaseException):
+                        logger.error(
+                            f"*РАССЫЛКА* Ошибка при удалении старого файла: {result}"
+                        )
 
-        # Список словарей со всеми данными для рассылки
-        mailing_data = []
+            # Получатели передаются MAILING_CONCURRENCY обработчикам через
+            # ограниченную очередь: в памяти нет задачи на каждого получателя,
+            # а первые сообщения уходят сразу
+            queue = asyncio.Queue(maxsize=MAILING_QUEUE_SIZE)
+            # file_id медиафайлов, уже загруженных в Telegram в этой рассылке
+            file_ids = {}
+            upload_locks = defaultdict(asyncio.Lock)
+            # Получатели, заблокировавшие бота или удаленные из Telegram
+            unreachable = []
+            workers = [
+                asyncio.create_task(
+                    _mailing_worker(queue, file_ids, upload_locks, unreachable)
+                )
+                for _ in range(MAILING_CONCURRENCY)
+            ]
+            try:
+                for recipient in _iter_recipients(
+                    users_with_content, referrals_by_owner
+                ):
+                    await queue.put(recipient)
+                await queue.join()
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+            if unreachable:
+                sample = ", ".join(unreachable[:UNREACHABLE_LOG_SAMPLE])
+                logger.info(
+                    f"*РАССЫЛКА* Недоступны {len(unreachable)} получателей, "
+                    f"например: {sample}"
+                )
+                # Полный список собирается, только если включен уровень DEBUG
+                logger.opt(lazy=True).debug(
+                    "*РАССЫЛКА* Все недоступные получатели: {}",
+                    lambda: ", ".join(unreachable),
+                )
+                await mark_users_blocked(session, unreachable)
 
-        for telegram_id, content in users_with_content.items():
-            # Получаем список рефералов пользователя
-            referral_telegram_ids = await find_all_referral_telegram_id(
-                async_session, telegram_id
+            # Отмечаем сообщения как разосланные, чтобы не отправить их повторно
+            await mark_content_plan_sent(
+                session,
+                [content["content_id"] for content in users_with_content.values()],
             )
-            if referral_telegram_ids:
-                # Формируем словарь со списком рефералов и данными для смс
-                mailing_entry = {
-                    "telegram_ids": referral_telegram_ids,
-                    "message": content["message"],
-                    "media_path": content["media_path"],
-                }
-                mailing_data.append(mailing_entry)
-
-        for mailing_entry in mailing_data:
-            telegram_ids = mailing_entry["telegram_ids"]
-            message = mailing_entry["message"]
-            media_path = mailing_entry["media_path"]
-
-            if media_path:
-                media_extension = Path(media_path).suffix.lower()
-                if media_extension in (".jpg", ".jpeg", ".png"):
-                    media_type = "photo"
-                elif media_extension in (".mp4", ".avi", ".mov"):
-                    media_type = "video"
-                else:
-                    media_type = "document"
-            else:
-                media_type = None
-
-            for telegram_id in telegram_ids:
-                try:
-                    if media_type:
-                        try:
-                            media = types.InputFile(media_path)
-                        except FileNotFoundError:
-                            logger.debug(f"*РАССЫЛКА* Не найден файл: {media_path}")
-                            continue
-
-                        if media_type == "photo":
-                            await bot.send_photo(
-                                chat_id=telegram_id, photo=media, caption=message
-                            )
-                        elif media_type == "video":
-                            await bot.send_video(
-                                chat_id=telegram_id, video=media, caption=message
-                            )
-                        else:
-                            await bot.send_document(
-                                chat_id=telegram_id, document=media, caption=message
-                            )
-
-                    else:
-                        # Отправка сообщения без медиа
-                        await bot.send_message(chat_id=telegram_id, text=message)
-                except (BotBlocked, ChatNotFound):
-                    pass
+            await session.commit()
 
     except Exception as error:
         logger.exception(
             f"*РАССЫЛКА* Произошла ошибка в функции send_content_to_referrals: {error}"
         )
+
+
+async def start_content_mailing() -> Optional[asyncio.Task]:
+    """
+    Запускает send_content_to_referrals фоновой задачей и сразу возвращается.
+    Вызывается планировщиком (aiocron) вместо await send_content_to_referrals(),
+     чтобы рассылка не задерживала вызывающий код.
+
+    Примечания:
+    - Если предыдущая рассылка еще идет, новая не запускается: иначе два
+     запуска разослали бы одни и те же сообщения до mark_content_plan_sent.
+
+    Возвращает:
+    - Фоновая задача рассылки или None, если рассылка уже выполняется.
+    """
+    global _mailing_task
+
+    if _mailing_task is not None and not _mailing_task.done():
+        logger.warning(
+            "*РАССЫЛКА* Предыдущая рассылка еще не завершена, запуск пропущен"
+        )
+        return None
+
+    _mailing_task = asyncio.create_task(send_content_to_referrals())
+    return _mailing_task
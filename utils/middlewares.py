@@ -0,0 +1,119 @@
+import sys
+from functools import wraps
+
+from aiogram import types
+from aiogram.dispatcher.handler import ctx_data
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from sqlalchemy.exc import SQLAlchemyError
+
+from database.sessions import session_failed
+from logging_errors.logging_setup import logger
+
+# Ключ в данных обработчика aiogram: db_guard отмечает им перехваченную ошибку,
+# чтобы DbSessionMiddleware откатил транзакцию вместо фиксации
+HANDLER_FAILED_KEY = "db_handler_failed"
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Открывает одну AsyncSession на обновление и передает ее в обработчик.
+
+    Подключение:
+    - dp.middleware.setup(DbSessionMiddleware(async_session))
+    - Обработчик получает сессию, если объявлен параметр session:
+     async def handler(message: types.Message, session: AsyncSession)
+     и передает ее в функции database.queries вместо async_session.
+
+    Примечания:
+    - Все запросы обработчика выполняются на одном соединении из пула и видят
+     один снимок данных.
+    - Функции БД не фиксируют изменения в переданной сессии (см.
+     database.sessions.transaction_scope): все записи обработчика фиксируются
+     одним commit здесь.
+    - aiogram вызывает post_process из finally, то есть и после ошибки
+     обработчика. Транзакция фиксируется, только если обработчик завершился
+     успешно: если исключение еще распространяется (sys.exc_info), его
+     перехватил db_guard (HANDLER_FAILED_KEY) или функция БД получила ошибку
+     запроса (session_failed), изменения откатываются.
+    - При ошибке фиксации транзакция тоже откатывается. Сессия закрывается
+     в любом случае.
+    """
+
+    def __init__(self, session_maker):
+        super().__init__()
+        self.session_maker = session_maker
+
+    async def _open_session(self, data: dict):
+        data["session"] = self.session_maker()
+
+    async def _close_session(self, data: dict):
+        session = data.pop("session", None)
+        handler_failed = data.pop(HANDLER_FAILED_KEY, False)
+        if session is None:
+            return
+        # post_process вызывается из finally: исключение обработчика, если оно
+        # было, еще распространяется и доступно через sys.exc_info()
+        handler_failed = (
+            handler_failed
+            or sys.exc_info()[1] is not None
+            or session_failed(session)
+        )
+        try:
+            if handler_failed:
+                await session.rollback()
+            elif session.in_transaction():
+                await session.commit()
+        except Exception as error:
+            await session.rollback()
+            logger.exception(
+                f"*БД* Произошла ошибка при фиксации сессии обработчика: {error}"
+            )
+        finally:
+            await session.close()
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        await self._open_session(data)
+
+    async def on_post_process_message(
+        self, message: types.Message, results: list, data: dict
+    ):
+        await self._close_session(data)
+
+    async def on_pre_process_callback_query(
+        self, callback_query: types.CallbackQuery, data: dict
+    ):
+        await self._open_session(data)
+
+    async def on_post_process_callback_query(
+        self, callback_query: types.CallbackQuery, results: list, data: dict
+    ):
+        await self._close_session(data)
+
+
+def db_guard(handler):
+    """
+    Декоратор обработчика бота: перехватывает ошибки БД в одном месте.
+
+    Примечания:
+    - Функции чтения из database.queries не перехватывают исключения, поэтому
+     ошибка подключения или запроса доходит до обработчика. db_guard логирует ее
+     и возвращает None, как раньше возвращали сами функции БД.
+    - functools.wraps сохраняет __wrapped__, поэтому aiogram по-прежнему видит
+     параметры исходного обработчика (например, session от DbSessionMiddleware).
+    - Перехваченная ошибка отмечается в данных обработчика (HANDLER_FAILED_KEY),
+     и DbSessionMiddleware откатывает транзакцию обновления.
+    """
+
+    @wraps(handler)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await handler(*args, **kwargs)
+        except (SQLAlchemyError, OSError) as error:
+            data = ctx_data.get(None)
+            if data is not None:
+                data[HANDLER_FAILED_KEY] = True
+            logger.exception(
+                f"*БД* Произошла ошибка в обработчике {handler.__name__}: {error}"
+            )
+
+    return wrapper
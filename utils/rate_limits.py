@@ -0,0 +1,12 @@
+from aiolimiter import AsyncLimiter
+
+# Telegram допускает около 30 сообщений в секунду от одного бота. Лимит делится
+# между рассылкой и ответами пользователям, чтобы долгая рассылка не занимала
+# весь лимит и ответы на команды не ждали ее окончания.
+
+# Лимит отправок рассылки по контент-плану (utils.mailing)
+BROADCAST_LIMITER = AsyncLimiter(max_rate=20, time_period=1)
+
+# Лимит ответов обработчиков команд и сообщений пользователей:
+# async with INTERACTIVE_LIMITER: await message.answer(...)
+INTERACTIVE_LIMITER = AsyncLimiter(max_rate=10, time_period=1)